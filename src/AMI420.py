@@ -1,18 +1,40 @@
 import instrument
-import datetime
 import enum
 import threading
 import time
 import queue
+import collections
+import weakref
+import functools
+import math
 
 
-def get_float_value(*args, **kwargs):
-    try:
-        return instrument.get_float_value(*args, **kwargs)
-    except instrument.OutOfRangeError:
-        raise instrument.ProtocolError('-105,"Out of range"')
-    except instrument.InvalidArgumentError:
-        raise instrument.ProtocolError('-102,"Invalid argument"')
+def ami_errors(f):
+    """Report argument errors of `f` with the AMI420 error codes"""
+    # Looked up once here rather than as module attributes on every call.
+    # The errors themselves are created anew, as an exception instance
+    # collects traceback frames every time it is raised.
+    out_of_range = instrument.OutOfRangeError
+    invalid_argument = instrument.InvalidArgumentError
+    protocol_error = instrument.ProtocolError
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except out_of_range:
+            raise protocol_error('-105,"Out of range"')
+        except invalid_argument:
+            raise protocol_error('-102,"Invalid argument"')
+
+    return wrapper
+
+
+get_float_value = ami_errors(instrument.get_float_value)
+
+
+def compile_float_parser(*args, **kwargs):
+    return ami_errors(instrument.compile_float_parser(*args, **kwargs))
 
 
 class AMI420_RampThread(threading.Thread):
@@ -27,70 +49,134 @@ class AMI420_RampThread(threading.Thread):
         HEATING = 8
         AT_ZERO = 9
 
-    def __init__(self, magnet):
-        super().__init__()
-        self.magnet = magnet
-        self.ramp_button = threading.Event()
-        self.pause_button = threading.Event()
-        #        self.incr_button = threading.Event()
-        #        self.decr_button = threading.Event()
-        self.zero_button = threading.Event()
-        self.quench_event = threading.Event()
-        self.shutdown = threading.Event()
-        self.state_change = threading.Event()
+    class Cmd(enum.IntEnum):
+        RAMP = 1
+        PAUSE = 2
+        ZERO = 3
+        QUENCH = 4
+        SHUTDOWN = 5
+        RATE = 6  # The ramp rate has changed
+        RESET = 7
+
+    def __init__(self, magnet, debug=False):
+        # A forgotten `shutdown()` must not keep the interpreter from exiting
+        super().__init__(daemon=True)
+        # A running thread is never collected, so a strong reference here
+        # would keep the magnet (and its finalizer) alive forever
+        self.magnet = weakref.proxy(magnet)
+        self.debug = debug
+        self.cmds = queue.Queue()
         self.state = self.State.AT_ZERO
-        self.msgs = queue.Queue()
-
-        self.tick = 0.05
+        self.msgs = collections.deque(maxlen=128)
+
+    def press(self, cmd):
+        """Queue a command, interrupting a running ramp"""
+        self.cmds.put(cmd)
+
+    def log(self, msg):
+        """Keep `msg` for `drain`, if debugging"""
+        if self.debug:
+            self.msgs.append(msg)
+
+    def drain(self):
+        """Return and forget all the log messages collected so far"""
+        msgs = []
+        try:
+            while True:
+                msgs.append(self.msgs.popleft())
+        except IndexError:
+            pass
+        # Ramp progress is logged as (field, voltage) and only formatted here
+        return [
+            msg if isinstance(msg, str) else "Field: {}, voltage: {}".format(*msg)
+            for msg in msgs
+        ]
 
     def run(self):
-        while not self.shutdown.is_set():
-            if self.ramp_button.is_set():
-                self.msgs.put("RAMP button")
-                self.ramp_button.clear()
+        try:
+            self.serve()
+        except ReferenceError:
+            # The magnet was collected while ramping, its finalizer stops us
+            pass
+
+    def serve(self):
+        cmd = self.cmds.get()
+        while cmd != self.Cmd.SHUTDOWN:
+            # A ramp returns the command that interrupted it
+            interrupt = None
+            if cmd == self.Cmd.RAMP:
+                self.log("RAMP button")
                 self.state = self.State.RAMPING
-                self.ramp(self.magnet.field_target)
-            elif self.pause_button.is_set():
-                self.msgs.put("PAUSE button")
-                self.pause_button.clear()
+                interrupt = self.ramp(self.magnet.field_target)
+            elif cmd == self.Cmd.PAUSE:
+                self.log("PAUSE button")
                 self.state = self.State.HOLDING
-            elif self.zero_button.is_set():
-                self.msgs.put("ZERO button")
-                self.zero_button.clear()
+            elif cmd == self.Cmd.ZERO:
+                self.log("ZERO button")
                 self.state = self.State.ZEROING
-                self.ramp(0)
-            elif self.quench_event.is_set():
-                self.msgs.put("QUENCH!")
-                self.quench_event.clear()
-                self.state_change.clear()
+                interrupt = self.ramp(0)
+            elif cmd == self.Cmd.QUENCH:
+                self.log("QUENCH!")
                 self.state = self.State.QUENCHED
                 self.magnet.field = 0
                 self.magnet.voltage = 0
-            else:
-                time.sleep(self.tick)
+            elif cmd == self.Cmd.RESET:
+                self.log("RESET")
+                self.state = self.State.AT_ZERO
+                self.magnet.field = 0
+                self.magnet.voltage = 0
+            cmd = self.cmds.get() if interrupt is None else interrupt
 
     def ramp(self, target):
-        self.state_change.clear()
-        self.msgs.put(f"Starting a ramp to {target}")
-        while not self.state_change.is_set():
-            direction = -1 if self.magnet.field > target else 1
-            dB = min(
-                self.magnet.field_rate * self.tick, abs(self.magnet.field - target)
-            )
-            self.magnet.field += dB * direction
-            self.magnet.voltage = (
-                dB
-                * direction
-                / self.tick
-                * self.magnet.inductance
-                / self.magnet.coil_constant
-            )
-            self.msgs.put(f"Field: {self.magnet.field}, voltage: {self.magnet.voltage}")
-            if self.magnet.field == target:
-                self.state = self.State.AT_ZERO if target == 0 else self.State.HOLDING
-                return
-            time.sleep(self.tick)
-        self.state_change.clear()
+        magnet = self.magnet
+        if magnet.field == target:
+            self.state = self.State.AT_ZERO if target == 0 else self.State.HOLDING
+            return None
+        self.log(f"Starting a ramp to {target}")
+        ind_over_coil = magnet.inductance / magnet.coil_constant
+        # The field is linear in time, so the magnet computes it when asked
+        # and the thread only wakes up when the ramp ends or is interrupted.
+        while True:
+            field = magnet.field
+            rate = magnet.field_rate
+            slope = math.copysign(rate, target - field)
+            duration = abs(target - field) / rate if rate else None
+            magnet.sweep(slope, duration)
+            magnet.voltage = slope * ind_over_coil
+            self.log((field, magnet.voltage))
+            try:
+                cmd = self.cmds.get(timeout=duration)
+            except queue.Empty:
+                break
+            if cmd != self.Cmd.RATE:
+                magnet.field = magnet.field  # Stop where we are
+                magnet.voltage = 0
+                return cmd
+            # Otherwise replan with the new rate
+        magnet.field = target
+        magnet.voltage = 0
+        self.state = self.State.AT_ZERO if target == 0 else self.State.HOLDING
+        return None
+
+
+# Readbacks of booleans and states, formatted in advance
+_BOOL_STR = ("0", "1")
+_STATE_STR = {state: str(int(state)) for state in AMI420_RampThread.State}
+
+
+def format_value(value):
+    """Format a numeric readback"""
+    # -0.0 is the same key as 0.0, so it must not depend on which came first
+    return f"{value + 0.0:.4f}"
+
+
+def stop_ramp_thread(thread, timeout=1.0):
+    # SHUTDOWN preempts a ramp, so the join is normally immediate; the
+    # timeout only keeps a wedged (daemon) thread from hanging the caller.
+    thread.press(AMI420_RampThread.Cmd.SHUTDOWN)
+    # The magnet may be collected by the ramp thread itself, which cannot join
+    if thread is not threading.current_thread():
+        thread.join(timeout)
 
 
 def dummy_write(self, *args):
@@ -105,7 +191,7 @@ class AMI420(instrument.VirtualInstrument):
     """A virtual Americal Magnetics, Inc. Model 420 power supply programmer.
     
     Following changes have been made due to the nature of this library.
-    * Error buffer never overflows
+    * Error buffer keeps the last 256 errors, older ones are silently dropped
     * Boolean parameters accept `ON` and `OFF`
     * All parameters accept `DEFault`
     * It's not possible to turn the device off
@@ -118,7 +204,7 @@ class AMI420(instrument.VirtualInstrument):
 
     # System-Related Commands
 
-    commands["*TST?"] = lambda s: "1"
+    commands.add_constants({"*TST?": "1"})
     commands[":SYSTem:LOCal"] = dummy_write
     commands[":SYSTem:REMote"] = dummy_write
 
@@ -138,74 +224,79 @@ class AMI420(instrument.VirtualInstrument):
 
     @commands.add(":SYSTem:TIME?")
     def runtime(self):
-        delta = datetime.datetime.now() - self.poweron_time
-        delta = delta.seconds
-        return f"{delta//3600:02d}:{(delta//60)%60:02d}:{delta%60:02d}"
+        hours, delta = divmod(int(time.monotonic() - self.poweron_time), 3600)
+        minutes, seconds = divmod(delta, 60)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
     @commands.add(":SYSTem:TIME:RESet")
     def reset_time(self):
-        self.poweron_time = datetime.datetime.now()
+        self.poweron_time = time.monotonic()
 
     # These can only be set via front panel...
-    commands[":SUPPly:VOLTage:MINimum"] = lambda s: "-10"
-    commands[":SUPPly:VOLTage:MAXimum"] = lambda s: "10"
-    commands[":SUPPly:CURRent:MINimum"] = lambda s: "-100"
-    commands[":SUPPly:CURRent:MAXimum"] = lambda s: "100"
-
-    # Custom power supply
-    commands[":SUPPly:TYPE"] = lambda s: "9"
-    # -10 -- 10
-    commands[":SUPPly:MODE"] = lambda s: "3"
+    commands.add_constants(
+        {
+            ":SUPPly:VOLTage:MINimum?": "-10",
+            ":SUPPly:VOLTage:MAXimum?": "10",
+            ":SUPPly:CURRent:MINimum?": "-100",
+            ":SUPPly:CURRent:MAXimum?": "100",
+            # Custom power supply
+            ":SUPPly:TYPE?": "9",
+            # -10 -- 10
+            ":SUPPly:MODE?": "3",
+        }
+    )
 
     @commands.add(":STABility?")
     def get_stability(self):
-        return "{:.4f}".format(self.stability)
+        return format_value(self.stability)
 
     @commands.add(":CONFigure:STABility")
     def set_stability(self, parsed_value):
-        self.stability = get_float_value(
-            parsed_value, default=0.0, min_max=(0.0, 100.0)
-        )
+        self.stability = self._parse_stability(parsed_value)
+
+    _parse_stability = staticmethod(
+        compile_float_parser(default=0.0, min_max=(0.0, 100.0))
+    )
 
     @commands.add(":CURRent:LIMit?")
     def get_current_limit(self):
-        return "{:.4f}".format(self.current_limit)
+        return format_value(self.current_limit)
 
     @commands.add(":CONFigure:CURRent:LIMit")
     def set_current_limit(self, parsed_value):
-        self.current_limit = get_float_value(
-            parsed_value, default=100.0, min_max=(0, 100), units="A"
-        )
+        self.current_limit = self._parse_current_limit(parsed_value)
+
+    _parse_current_limit = staticmethod(
+        compile_float_parser(default=100.0, min_max=(0, 100), units="A")
+    )
 
     commands[":CONFigure:COILconst"] = not_implemented
 
     @commands.add(":COILconst")
     def get_coil_constant(self):
-        return "{:.4f}".format(self.coil_constant / self.field_unit_multiplier())
+        return format_value(self.to_field_units(self.coil_constant))
 
     #   No, the users cannot change the coil
     commands[":CONFigure:COILconst"] = not_implemented  # <value (kG/A, T/A)>
 
     # This device has no absorber
     commands[":CONFigure:ABsorber"] = not_implemented  # {0,1}
-    commands[":ABsorber"] = lambda s: "0"
+    commands.add_constants({":ABsorber?": "0"})
 
     # Switch Heater Commands and Queries
 
     # This device has no persistent switch
     commands[":CONFigure:PSwitch"] = not_implemented  # {0|1}
 
-    commands[":VOLTage:PSwitch"] = lambda s: "0"
-    commands[":PSwitch?"] = lambda s: "0"
+    commands.add_constants({":VOLTage:PSwitch?": "0", ":PSwitch?": "0"})
 
     @commands.add(":PSwitch")
     def get_pswitch(self, parsed_value):
         self.log_error(f"No persistent switch installed")
 
     commands[":CONFigure:PSwitch:CURRent"] = not_implemented  # <current (A)>
-    commands[":PSwitch:CURRent"] = lambda s: "0"
     commands[":CONFigure:PSwitch:TIME"] = not_implemented  # <time (sec)>
-    commands[":PSwitch:TIME"] = lambda s: "0"
+    commands.add_constants({":PSwitch:CURRent?": "0", ":PSwitch:TIME?": "0"})
 
     RAMP_RATE_SECONDS = False
     RAMP_RATE_MINUTES = True
@@ -213,25 +304,52 @@ class AMI420(instrument.VirtualInstrument):
     FIELD_KILOGAUSS = False
     FIELD_TESLA = True
 
-    def field_unit_multiplier(self):
-        if self.field_units == self.FIELD_TESLA:
-            return 1
-        elif self.field_units == self.FIELD_KILOGAUSS:
-            return 0.1
+    # The unit multipliers are looked up on every query, so they are cached
+    # whenever the units change.
+
+    @property
+    def field_units(self):
+        return self._field_units
+
+    @field_units.setter
+    def field_units(self, value):
+        if value == self.FIELD_TESLA:
+            self._field_mul = 1
+            self._inv_field_mul = 1
+        elif value == self.FIELD_KILOGAUSS:
+            self._field_mul = 0.1
+            self._inv_field_mul = 10
+        else:
+            raise ValueError(f"Unknown field units {value}")
+        self._field_units = value
+
+    @property
+    def ramp_rate_units(self):
+        return self._ramp_rate_units
+
+    @ramp_rate_units.setter
+    def ramp_rate_units(self, value):
+        if value == self.RAMP_RATE_SECONDS:
+            self._ramp_mul = 1
+        elif value == self.RAMP_RATE_MINUTES:
+            self._ramp_mul = 1 / 60
         else:
-            raise ValueError(f"Unknown field units {self.field_units}")
+            raise ValueError(f"Unknown ramp rate units {value}")
+        self._ramp_rate_units = value
+
+    def field_unit_multiplier(self):
+        return self._field_mul
 
     def ramp_unit_multiplier(self):
-        if self.ramp_rate_units == self.RAMP_RATE_SECONDS:
-            return 1
-        elif self.ramp_rate_units == self.RAMP_RATE_MINUTES:
-            return 1 / 60
-        else:
-            raise ValueError(f"Unknown ramp rate units {self.ramp_rate_units}")
+        return self._ramp_mul
+
+    def to_field_units(self, field):
+        """Convert a field (or T/s, T/A) from T to the configured field units"""
+        return field * self._inv_field_mul
 
     @commands.add(":RAMP:RATE:UNITS?")
     def get_ramp_rate_units(self):
-        return str(int(self.ramp_rate_units))
+        return _BOOL_STR[self.ramp_rate_units]
 
     @commands.add(":CONFigure:RAMP:RATE:UNITS")
     def set_ramp_rate_units(self, parsed_value):
@@ -239,7 +357,7 @@ class AMI420(instrument.VirtualInstrument):
 
     @commands.add(":FIELD:UNITS?")
     def get_field_units(self):
-        return str(int(self.field_units))
+        return _BOOL_STR[self.field_units]
 
     @commands.add(":CONFigure:FIELD:UNITS")
     def set_field_units(self, parsed_value):
@@ -247,51 +365,52 @@ class AMI420(instrument.VirtualInstrument):
 
     # Ramp Target/Rate Configuration Commands and Queries
 
+    # Explicit units for the values that default to the configured ones
+    _FIELD_UNITS = {"T": 1, "G": 1e-4}
+    _FIELD_RATE_UNITS = {"G/s": 1e-4, "G/min": 1e-4 / 60, "T/s": 1, "T/min": 1 / 60}
+    _CURRENT_RATE_UNITS = {"A/s": 1, "A/min": 1 / 60}
+
     @commands.add(":VOLTage:LIMit?")
     def get_voltage_limit(self):
-        return "{:.4f}".format(self.voltage_limit)
+        return format_value(self.voltage_limit)
 
     @commands.add(":CONFigure:VOLTage:LIMit")
     def set_voltage_limit(self, parsed_value):  # <voltage (V)>
-        self.voltage_limit = get_float_value(
-            parsed_value, default=10.0, min_max=(0, 10)
-        )
+        self.voltage_limit = self._parse_voltage_limit(parsed_value)
+
+    _parse_voltage_limit = staticmethod(
+        compile_float_parser(default=10.0, min_max=(0, 10))
+    )
 
     @commands.add(":FIELD:PROGram?")
     def get_field_target(self):
-        return "{:.4f}".format(self.field_target / self.field_unit_multiplier())
+        return format_value(self.to_field_units(self.field_target))
 
     @commands.add(":CONFigure:FIELD:PROGram")
     def set_field_target(self, parsed_value):  # <field (kG, T)>
-        self.field_target = get_float_value(
-            parsed_value,
-            default=0,
-            min_max=(-100 * self.coil_constant, 100 * self.coil_constant),
-            units={"T": 1, "G": 1e-4, None: self.field_unit_multiplier},
+        self.field_target = self._parse_field_target(
+            parsed_value, default_scale=self._field_mul
         )
 
     @commands.add(":RAMP:RATE:FIELd?")
     def get_field_rate(self):
-        return f"{self.field_rate/self.ramp_unit_multiplier()/self.field_unit_multiplier():.4f}"
+        return format_value(self.to_field_units(self.field_rate) / self._ramp_mul)
 
     @commands.add(":CONFigure:RAMP:RATE:FIELd")
     def set_field_rate(self, rate):
-        units = {
-            "G/s": 1e-4,
-            "G/min": 1e-4 / 60,
-            "T/s": 1,
-            "T/min": 1 / 60,
-            None: lambda: self.ramp_unit_multiplier() * self.field_unit_multiplier(),
-        }
+        self.field_rate = self._parse_field_rate(
+            rate, default_scale=self._ramp_mul * self._field_mul
+        )
+        # A running ramp has to pick up the new rate
+        self.ramp_thread.press(AMI420_RampThread.Cmd.RATE)
 
-        self.field_rate = get_float_value(rate, (0, 1000), units=units)
+    _parse_field_rate = staticmethod(
+        compile_float_parser((0, 1000), units=_FIELD_RATE_UNITS)
+    )
 
     @commands.add(":RAMP:FIELd?")
     def get_field_ramp(self):
-        return (
-            f"{self.field_target/self.field_unit_multiplier():.4f},"
-            + self.get_field_rate()
-        )
+        return self.get_field_target() + "," + self.get_field_rate()
 
     @commands.add(
         ":CONFigure:RAMP:FIELd"
@@ -300,44 +419,39 @@ class AMI420(instrument.VirtualInstrument):
         self.set_field_target(field)
         self.set_field_rate(field_rate)
 
+    def to_current(self, field):
+        """Convert a field (or a field rate) in T to the coil current in A"""
+        return field * self._inv_coil
+
     @commands.add(":CURRent:PROGram?")
     def get_current_target(self):
-        return f"{self.field_target/self.coil_constant:.4f}"
+        return format_value(self.to_current(self.field_target))
 
     @commands.add(":CONFigure:CURRent:PROGram")
     def set_current_target(self, value):  # <current (A)>
-        self.field_target = (
-            get_float_value(value, min_max=(-100, 100), units="A") * self.coil_constant
-        )
+        self.field_target = self._parse_current(value) * self.coil_constant
+
+    _parse_current = staticmethod(compile_float_parser((-100, 100), units="A"))
 
     @commands.add(":RAMP:RATE:CURRent?")
     def get_current_rate(self):
-        return "{:.4f}".format(
-            self.field_rate
-            / self.ramp_unit_multiplier()
-            / self.field_unit_multiplier()
-            / self.coil_constant
-        )
+        return format_value(self.to_current(self.field_rate) / self._ramp_mul)
 
     @commands.add(":CONFigure:RAMP:RATE:CURRent")  # <rate (A/s, A/min)>
     def set_current_rate(self, rate):
         self.field_rate = (
-            get_float_value(
-                rate,
-                min_max=(0, 1000),
-                units={"A/s": 1, "A/min": 1 / 60, None: self.ramp_unit_multiplier},
-            )
+            self._parse_current_rate(rate, default_scale=self._ramp_mul)
             * self.coil_constant
         )
+        self.ramp_thread.press(AMI420_RampThread.Cmd.RATE)
+
+    _parse_current_rate = staticmethod(
+        compile_float_parser((0, 1000), units=_CURRENT_RATE_UNITS)
+    )
 
     @commands.add(":RAMP:CURRent?")
     def get_current_ramp(self):
-        return (
-            "{:.4f},".format(
-                self.field_target / self.field_unit_multiplier() / self.coil_constant
-            )
-            + self.get_current_rate()
-        )
+        return self.get_current_target() + "," + self.get_current_rate()
 
     @commands.add(":CONFigure:RAMP:CURRent")  # <current (A)><rate (A/s, A/min)>
     def set_current_ramp(self, current, current_rate):
@@ -348,25 +462,22 @@ class AMI420(instrument.VirtualInstrument):
 
     @commands.add(":RAMP")
     def start_ramp(self):
-        self.ramp_thread.ramp_button.set()
-        self.ramp_thread.state_change.set()
+        self.ramp_thread.press(AMI420_RampThread.Cmd.RAMP)
 
     @commands.add(":PAUSE")
     def pause_ramp(self):
-        self.ramp_thread.pause_button.set()
-        self.ramp_thread.state_change.set()
+        self.ramp_thread.press(AMI420_RampThread.Cmd.PAUSE)
 
     commands[":UP"] = not_implemented
     commands[":DOWN"] = not_implemented
 
     @commands.add(":ZERO")
     def zero_ramp(self):
-        self.ramp_thread.zero_button.set()
-        self.ramp_thread.state_change.set()
+        self.ramp_thread.press(AMI420_RampThread.Cmd.ZERO)
 
     @commands.add(":STATE?")
     def get_ramp_state(self):
-        return str(int(self.ramp_thread.state))
+        return _STATE_STR[self.ramp_thread.state]
 
     # Measurement Commands and Queries
 
@@ -374,21 +485,42 @@ class AMI420(instrument.VirtualInstrument):
     # In our ideal universe, the supply voltage drops only in the magnet
     @commands.add(":VOLTage:SUPPly?")
     def get_voltage(self):
-        return f"{self.voltage:.4f}"
+        return format_value(self.voltage)
 
     @commands.add(":CURRent:MAGnet?")
     @commands.add(":CURRent:SUPPly?")
     def get_current(self):
-        return f"{self.field/self.coil_constant:.4f}"
+        return format_value(self.to_current(self.field))
 
     @commands.add(":FIELD:MAGnet?")
     def get_field(self):
-        return f"{self.field/self.field_unit_multiplier():.4f}"
+        return format_value(self.to_field_units(self.field))
+
+    @property
+    def field(self):
+        """The field in T, following the linear sweep set by `sweep`"""
+        sweep = self._sweep
+        if sweep is None:
+            return self._field
+        t0, field0, slope, t_end = sweep
+        return field0 + slope * (min(time.monotonic(), t_end) - t0)
+
+    @field.setter
+    def field(self, value):
+        # In this order, so that a concurrent read never sees the old field
+        self._field = value
+        self._sweep = None
+
+    def sweep(self, slope, duration=None):
+        """Change the field by `slope` T/s from now on, for `duration` s or forever"""
+        t0 = time.monotonic()
+        t_end = math.inf if duration is None else t0 + duration
+        self._sweep = (t0, self.field, slope, t_end)
 
     # Protection Setup Configuration Commands and Queries
     @commands.add(":QUench:DETect?")
     def get_quench_detect(self):
-        return str(int(self.quench_detect))
+        return _BOOL_STR[self.quench_detect]
 
     @commands.add(":CONFigure:QUench:DETect")
     def set_quench_detect(self, parsed_value):
@@ -404,11 +536,9 @@ class AMI420(instrument.VirtualInstrument):
     def quench(self, parsed_value):
         if instrument.get_bool_value(parsed_value):
             if self.ramp_thread.state != AMI420_RampThread.State.QUENCHED:
-                self.ramp_thread.quench_event.set()
-                self.ramp_thread.state_change.set()
+                self.ramp_thread.press(AMI420_RampThread.Cmd.QUENCH)
         elif self.ramp_thread.state == AMI420_RampThread.State.QUENCHED:
-            # There's no state change event since the thread is in the main loop here.
-            self.ramp_thread.pause_button.set()
+            self.ramp_thread.press(AMI420_RampThread.Cmd.PAUSE)
 
     @commands.add("*RST")
     def reset(self):
@@ -428,22 +558,37 @@ class AMI420(instrument.VirtualInstrument):
         self.field_rate = 0.0
         self.quench_detect = False
 
+        # Not there yet when called from __init__
+        if hasattr(self, "ramp_thread"):
+            # Stop a ramp, which would otherwise finish at its target
+            self.ramp_thread.press(AMI420_RampThread.Cmd.RESET)
+
         super().reset()
 
     def __init__(self, coil_constant, inductance):
 
         self.coil_constant = coil_constant
+        self._inv_coil = 1 / coil_constant
         self.inductance = inductance
+        # The field limits depend on the coil constant
+        self._parse_field_target = compile_float_parser(
+            default=0,
+            min_max=(-100 * coil_constant, 100 * coil_constant),
+            units=self._FIELD_UNITS,
+        )
 
         super().__init__("AMERICAN MAGNETICS INC.,MODEL 420,virtual")
 
         self.ramp_thread = AMI420_RampThread(self)
         self.ramp_thread.start()
+        # Unlike __del__, this only needs the thread and still runs at exit
+        self._finalizer = weakref.finalize(self, stop_ramp_thread, self.ramp_thread)
 
     def shutdown(self):
-        self.ramp_thread.shutdown.set()
-        self.ramp_thread.state_change.set()
-        self.ramp_thread.join()
+        self._finalizer()
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
+    def __exit__(self, *exc_info):
         self.shutdown()
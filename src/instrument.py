@@ -1,3 +1,5 @@
+import collections
+import functools
 import queue
 import scpi
 from enum import IntEnum
@@ -19,48 +21,97 @@ class InvalidArgumentError(ProtocolError):
 
 
 def deep_copy_dict(old, new):
-    for key, value in old.items():
-        if isinstance(value, dict):
-            new[key] = deep_copy_dict(value, {})
-        else:
-            new[key] = value
+    # Iterative, no need for a Python call per nested dict
+    stack = [(old, new)]
+    while stack:
+        src, dst = stack.pop()
+        for key, value in src.items():
+            if isinstance(value, dict):
+                dst[key] = copy = {}
+                stack.append((value, copy))
+            else:
+                dst[key] = value
     return new
 
 
+def drain_queue(q):
+    """Take everything waiting in the `queue.Queue` q at once, under a single lock.
+
+    The items are marked as done right away, so `q.join()` keeps working.
+    """
+    with q.mutex:
+        items = list(q.queue)
+        if items:
+            q.queue.clear()
+            q.not_full.notify_all()
+            q.unfinished_tasks -= len(items)
+            if not q.unfinished_tasks:
+                q.all_tasks_done.notify_all()
+    return items
+
+
+class InputQueue(queue.Queue):
+    """The input queue of an instrument.
+
+    If set, `on_input` is called when a line is put into the empty queue, so that
+    whoever answers the lines learns that there is something to answer, whoever
+    put it there. It is called with the queue locked and must not block.
+    """
+
+    on_input = None
+
+    def _put(self, item):
+        if not self.queue and self.on_input is not None:
+            self.on_input()
+        super()._put(item)
+
+
 class CommandTree:
     def __init__(self, other=None, ignore_case=True):
         self.tree = {}
         self.ignore_case = ignore_case
+        self._flat = None
         if other is not None:
             if isinstance(other, CommandTree):
                 deep_copy_dict(other.tree, self.tree)
             else:
                 deep_copy_dict(other, self.tree)
 
-    @classmethod
-    def parent(self, command):
-        if command.startswith("*"):
-            return ""
-        if not command.startswith(":"):
-            raise ValueError(command)
-        return command[: command.rindex(":")]
-
     def __getitem__(self, key):
-        query = key.endswith("?")
+        return self.lookup(key)[0]
 
-        if key.startswith("*"):
-            if query:
-                return self.tree[key[:-1]][None][1]
-            else:
-                return self.tree[key][None][0]
-        if not key.startswith(":"):
-            raise KeyError(key)
+    def lookup(self, key):
+        """Find the handler for a full `key` along with the `parent` of `key`"""
+        if self._flat is None:
+            self._flat = self.flatten()
 
-        dct = self.tree
-        for tkn in key[1:].strip("?").split(":"):
-            dct = dct[tkn]
+        if key.endswith("?"):
+            handlers, parent = self._flat[key[:-1]]
+            return handlers[1], parent
+        else:
+            handlers, parent = self._flat[key]
+            return handlers[0], parent
+
+    def flatten(self):
+        """Map every full spelling of every command (without `?`) to its handlers and parent.
+
+        This is what `lookup` searches, so that a command is found with a single
+        dict lookup instead of one per mnemonic, and without working out its parent.
+        It is rebuilt on the first lookup after the tree changes.
+        """
+        flat = {}
+
+        def walk(prefix, parent, dct):
+            for tkn, value in dct.items():
+                if tkn is None:
+                    flat[prefix] = value, parent
+                elif tkn.startswith("*"):
+                    walk(tkn, "", value)
+                else:
+                    walk(prefix + ":" + tkn, prefix, value)
 
-        return dct[None][int(query)]
+        walk("", "", self.tree)
+        return flat
 
     def __setitem__(self, key, value):
         def step_tree(dicts, tokens):
@@ -84,6 +135,7 @@ class CommandTree:
         except scpi.pp.ParseException as e:
             raise KeyError(e.msg)
 
+        self._flat = None
         for d in step_tree([self.tree], tokens):
             if None not in d:
                 if query:
@@ -103,23 +155,94 @@ class CommandTree:
 
         return wrapper
 
+    def add_constants(self, constants):
+        """Register fixed responses, given as a {key: response} dict.
+
+        A string stored in place of a handler is returned as-is when the command is run.
+        """
+        for key, value in constants.items():
+            self[key] = value
+
+
+# Polled queries are short, long lines would only evict them from the cache
+MAX_CACHED_LINE = 256
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_cached_line(line):
+    return scpi.parse(line).commands
+
+
+def parse_line(line):
+    """The commands of a program message, parsed once for lines that keep coming back.
+
+    The parse results are shared between calls and must not be modified.
+    """
+    if len(line) > MAX_CACHED_LINE:
+        return scpi.parse(line).commands
+    return _parse_cached_line(line)
+
+
+# SCPI is ASCII, so only ASCII letters need uppercasing
+_UPPERCASE = bytes.maketrans(
+    b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+)
+
 
 class SCPI_receiver:
     def __init__(self):
-        self.iqueue = queue.Queue()
+        # Unbounded, hooks must be able to write here without blocking;
+        # the server pauses flooding clients instead, see `Server.pass_lines`
+        self.iqueue = InputQueue()
         self.oqueue = queue.Queue()
-        self.error_log = []
+        # The oldest errors are dropped if nobody reads them
+        self.error_log = collections.deque(maxlen=256)
         self.lineending = b"\n"
 
+    @property
+    def lineending(self):
+        return self._lineending
+
+    @lineending.setter
+    def lineending(self, value):
+        # Replies are joined as str and encoded once, see `process_messages`
+        self._lineending = value
+        self._reply_separator = value.decode("latin1")
+
     def log_error(self, message):
         self.error_log.append(message)
 
+    def resolve(self, parent, header):
+        """Find the handler for `header` sent at the level `parent`.
+
+        Returns the handler and the level that the next command in the line is relative to.
+        """
+        if header.startswith("*"):
+            try:
+                return self.commands.lookup(header)
+            except KeyError:
+                raise ProtocolError(f"Unsupported common mnemonic {header}")
+        elif header.startswith(":"):
+            try:
+                return self.commands.lookup(header)
+            except KeyError:
+                raise ProtocolError(f"Unsupported command {header}")
+        else:
+            try:
+                return self.commands.lookup(parent + ":" + header)
+            except KeyError:
+                raise ProtocolError(
+                    f"Unsupported command {header} at current level {parent}"
+                )
+
     def process(self, line):
         """Run every command in a command list, separated by semicolons (IEEE 488 PROGRAM_MESSAGE)
         """
         # This is a generator function so that the beginning of the line gets processed even if an error is encountered later
         parent = ""
-        for command in scpi.parse(line).commands:
+        # Headers repeated within the line are resolved only once
+        resolved = {}
+        for command in parse_line(line):
 
             if isinstance(command, str):
                 raise ProtocolError(f"Unparseable command `{command}`")
@@ -127,52 +250,42 @@ class SCPI_receiver:
             if not command.header:
                 continue
 
-            if command.header.startswith("*"):
-                try:
-                    handler = self.commands[command.header]
-                except KeyError:
-                    raise ProtocolError(f"Unsupported common mnemonic {command.header}")
-                parent = ""
-            elif command.header.startswith(":"):
-                try:
-                    handler = self.commands[command.header]
-                except KeyError:
-                    raise ProtocolError(f"Unsupported command {command.header}")
-                parent = self.commands.parent(command.header)
-            else:
-                try:
-                    handler = self.commands[parent + ":" + command.header]
-                    parent = self.commands.parent(parent + ":" + command.header)
-                except KeyError:
-                    raise ProtocolError(
-                        f"Unsupported command {command.header} at current level {parent}"
-                    )
+            key = (parent, command.header)
+            try:
+                handler, parent = resolved[key]
+            except KeyError:
+                handler, parent = resolved[key] = self.resolve(*key)
 
             if handler is None:
                 raise ProtocolError(f"Unsupported form {command.header}")
+            elif isinstance(handler, str):
+                yield handler
             else:
                 yield handler(self, *command.args)
 
     def process_messages(self):
-        while not self.iqueue.empty():
-            if self.oqueue.full():
-                break
+        """Answer all the lines waiting in `iqueue` with a single write to `oqueue`.
 
-            try:
-                line = self.iqueue.get_nowait().decode("latin1").upper()
-            except queue.Empty:
-                # Should not really happen since this instrument
-                # is the only consumer
-                break
-
-            responses = []
-            try:
-                for response in self.process(line):
-                    responses.append(response)
-            except ProtocolError as e:
-                self.log_error(f"ERROR: {line} {e}")
-            finally:
-                self.oqueue.put(";".join(responses).encode("latin1") + b"\n")
+        Returns whether there was anything to answer.
+        """
+        replies = []
+        try:
+            for line in drain_queue(self.iqueue):
+                line = line.translate(_UPPERCASE).decode("latin1")
+                responses = []
+                try:
+                    for response in self.process(line):
+                        if response is not None:
+                            responses.append(response)
+                except ProtocolError as e:
+                    self.log_error(f"ERROR: {line} {e}")
+                finally:
+                    replies.append(";".join(responses))
+        finally:
+            if replies:
+                replies.append("")
+                self.oqueue.put(self._reply_separator.join(replies).encode("latin1"))
+        return bool(replies)
 
 
 SI_prefixes = {
@@ -191,53 +304,99 @@ SI_prefixes = {
 }
 
 
-def get_float_value(parse_value, min_max, default=None, units=None):
-    vmin, vmax = min_max
+def _suffix_table(units):
+    """Resolve every suffix allowed by a {unit: factor} dict to its multiplier.
 
-    if parse_value.getName() == "symbol":
-        if parse_value.symbol == "MAX" or parse_value.symbol == "MAXIMUM":
-            return vmin
-        elif parse_value.symbol == "MIN" or parse_value.symbol == "MINIMUM":
+    The table maps `<SI prefix><unit>` and the bare `<unit>`, uppercase, to the
+    factor, so that parsing a value takes one lookup instead of trying all the units
+    and prefixes. The units are tried in order, so the first unit that explains
+    a suffix wins. A `None` entry (the default units callable) is left out.
+    """
+    table = {}
+    for unit, factor in units.items():
+        if unit is None:
+            continue
+        unit = unit.upper()
+        table.setdefault(unit, factor)
+        for prefix, multiplier in SI_prefixes.items():
+            table.setdefault(prefix + unit, multiplier * factor)
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def _single_unit_table(unit):
+    return _suffix_table({unit: 1})
+
+
+@functools.lru_cache(maxsize=256)
+def _units_table(items):
+    return _suffix_table(dict(items))
+
+
+def _normalize_units(units):
+    """Bring the `units` accepted by `get_float_value` to a suffix table (or None)
+    and the callable giving the default units (or None).
+
+    The tables are cached, so a call with the same units does not rebuild one.
+    The callable is kept out of the cache: it may be a bound method or a fresh
+    lambda on every call, which would only miss and keep its instrument alive.
+    """
+    if isinstance(units, str):
+        return _single_unit_table(units), None
+    elif units is None:
+        return None, None
+    elif isinstance(units, dict):
+        items = tuple(item for item in units.items() if item[0] is not None)
+        return _units_table(items), units.get(None)
+    else:
+        return _single_unit_table(units.unit), None
+
+
+_MAX_SYMBOLS = frozenset(("MAX", "MAXIMUM"))
+_MIN_SYMBOLS = frozenset(("MIN", "MINIMUM"))
+_DEFAULT_SYMBOLS = frozenset(("DEF", "DEFAULT"))
+
+
+def _parse_float(
+    parse_value, vmin, vmax, default, units, default_units, default_scale=1
+):
+    """`get_float_value` for already unpacked limits, a suffix table for units
+    and the callable giving the default units"""
+    kind = parse_value.getName()
+    if kind == "symbol":
+        symbol = parse_value.symbol
+        if symbol in _MAX_SYMBOLS:
             return vmax
-        elif parse_value.symbol == "DEF" or parse_value.symbol == "DEFAULT":
+        elif symbol in _MIN_SYMBOLS:
+            return vmin
+        elif symbol in _DEFAULT_SYMBOLS:
             if default is None:
                 raise InvalidArgumentError()
             else:
                 return default
         else:
             raise InvalidArgumentError()
-    elif parse_value.getName() == "number":
-        factor = 1
+    elif kind == "number":
         suffix = parse_value.number.suffix.upper()
         if suffix:
             if units is None:
                 raise InvalidArgumentError()
-            elif isinstance(units, str):
-                units = {units: 1}
-            elif isinstance(units, dict):
-                pass
-            else:
-                units = {units.unit: 1}
 
-            for unit in units:
-                if unit is None:
-                    continue
-                try:
-                    if suffix.endswith(unit.upper()):
-                        prefix = suffix[: -len(unit)]
-                        if prefix:
-                            factor = SI_prefixes[prefix] * units[unit]
-                        else:
-                            factor = units[unit]
-                        break
-                except KeyError:
-                    continue
-            else:
+            try:
+                factor = units[suffix]
+            except KeyError:
                 raise InvalidArgumentError()
-        elif isinstance(units, dict):
-            factor = units[None]()
+        elif default_units is not None:
+            factor = default_units()
+        else:
+            # No suffix, the value is in the default units
+            factor = default_scale
 
-        value = parse_value.number.value * factor
+        try:
+            value = parse_value.number.value * factor
+        except OverflowError:
+            # An int too large for a float
+            raise OutOfRangeError()
         if value < vmin or value > vmax:
             raise OutOfRangeError()
         return value
@@ -245,6 +404,31 @@ def get_float_value(parse_value, min_max, default=None, units=None):
         raise InvalidArgumentError()
 
 
+def get_float_value(parse_value, min_max, default=None, units=None, default_scale=1):
+    vmin, vmax = min_max
+    units, default_units = _normalize_units(units)
+    return _parse_float(
+        parse_value, vmin, vmax, default, units, default_units, default_scale
+    )
+
+
+def compile_float_parser(min_max, default=None, units=None):
+    """Make a `get_float_value` with fixed limits, default and units.
+
+    The returned function only takes the parsed value (and `default_scale`),
+    the rest is unpacked and normalized once here instead of on every call.
+    """
+    vmin, vmax = min_max
+    units, default_units = _normalize_units(units)
+
+    def parser(parse_value, default_scale=1):
+        return _parse_float(
+            parse_value, vmin, vmax, default, units, default_units, default_scale
+        )
+
+    return parser
+
+
 def get_bool_value(parsed_value, default=False):
     if parsed_value.getName() == "number":
         return parsed_value.number.value != 0
@@ -271,9 +455,7 @@ def hookable(name):
     def wrapper(f):
         def hooked(self, *args, **kwargs):
             result = f(self, *args, **kwargs)
-            for hook in self.hooks.get(name, ()):
-                hook()
-            for hook in self.hooks.get(None, ()):
+            for hook in self._hook_lists.get(name, self._general_hooks):
                 hook()
             return result
 
@@ -293,7 +475,8 @@ class VirtualInstrument(SCPI_receiver):
     def __init__(self, name):
         self.name = name
         self.hooks = {None: []}
-        self.error_index = 0
+        self._hook_lists = {}
+        self._general_hooks = ()
 
         super().__init__()
         self.reset()
@@ -303,6 +486,14 @@ class VirtualInstrument(SCPI_receiver):
             self.hooks[name] = []
         self.hooks[name].append(hook)
 
+        # What a `hookable` method runs: its own hooks, then the ones for any change
+        self._general_hooks = tuple(self.hooks[None])
+        self._hook_lists = {
+            key: tuple(hooks) + self._general_hooks
+            for key, hooks in self.hooks.items()
+            if key is not None
+        }
+
     @commands.add("*IDN?")
     def identify(self):
         return self.name
@@ -348,8 +539,7 @@ class VirtualInstrument(SCPI_receiver):
 
     @commands.add("*ERR?")
     def last_error(self):
-        if self.error_index < len(self.error_log):
-            self.error_index += 1
-            return self.error_log[self.error_index - 1]
+        if self.error_log:
+            return self.error_log.popleft()
         else:
             return "No errors"
@@ -1,40 +1,57 @@
+import collections
+import functools
 import pyparsing as pp
 
 # from pyparsing import pyparsing_common as ppc
 import re
+import sys
 
-pp.ParserElement.enablePackrat()
+# No packrat: the alternatives here are disjoint, and memoizing made parsing ~2x slower
 pp.ParserElement.setDefaultWhitespaceChars(pp.srange("[\x00-\x09\x0b-\x20]"))
 
 program_mnemonic = pp.Word(pp.alphas, pp.alphanums + "_")
 
 character_program_data = program_mnemonic.copy()
 
-mantissa = (
-    pp.Combine(
-        pp.Optional(pp.Char("+-"))
-        + (
-            (pp.Char(".") + pp.Word(pp.nums))
-            | (
-                pp.Word(pp.nums)
-                + pp.Optional(pp.Char(".") + pp.Optional(pp.Word(pp.nums), default="0"))
-            )
+mantissa = pp.Combine(
+    pp.Optional(pp.Char("+-"))
+    + (
+        (pp.Char(".") + pp.Word(pp.nums))
+        | (
+            pp.Word(pp.nums)
+            + pp.Optional(pp.Char(".") + pp.Optional(pp.Word(pp.nums), default="0"))
         )
     )
-    .setResultsName("mantissa")
-    .setParseAction(lambda t: float(t[0]) if "." in t[0] else int(t[0]))
-)
+).setResultsName("mantissa")
 exponent = pp.Optional(
     pp.Char("eE")
     + pp.Combine(pp.Optional(pp.Char("+-")) + pp.Word(pp.nums))
     .setResultsName("exponent")
     .setParseAction(lambda t: int(t[0]))
 )
+
+
+def decimal_value(mantissa, exponent=None):
+    """The value of a decimal number from its mantissa text and (int) exponent.
+
+    Integers stay integers. A float is converted by `float` in one go,
+    as multiplying by a power of 10 would round twice (3e-1 -> 0.30000000000000004).
+    An integer with an exponent beyond the float range is a float too (inf),
+    rather than an int too large to compute or to multiply by a float.
+    """
+    if exponent is None:
+        return float(mantissa) if "." in mantissa else int(mantissa)
+    elif "." in mantissa or exponent < 0 or exponent > sys.float_info.max_10_exp:
+        return float(f"{mantissa}e{exponent}")
+    else:
+        return int(mantissa) * 10**exponent
+
+
 decimal_numeric_program_data = (
     (mantissa + exponent)
     .setResultsName("value")
     .setParseAction(
-        lambda t: t.mantissa * (10 ** t.exponent if t.exponent != "" else 1)
+        lambda t: decimal_value(t.mantissa, t.exponent if t.exponent != "" else None)
     )
 )
 
@@ -84,19 +101,28 @@ class FiniteBlock(pp.Token):
         if instring[loc] != "#":
             raise pp.ParseException(instring, loc, "Not a block", self)
         loc += 1
-        if instring[loc] not in "123456789":
+        if loc == len(instring) or instring[loc] not in "123456789":
             raise pp.ParseException(
-                instring, loc, f"Invalid block length length {instring[loc]}", self
+                instring,
+                loc,
+                f"Invalid block length length {instring[loc:loc+1]}",
+                self,
             )
-        ll = int(instring[loc])
+        ll = ord(instring[loc]) - 48  # A single digit, int() is not needed
         loc += 1
-        if loc + ll >= len(instring):
+        digits = instring[loc : loc + ll]
+        if len(digits) < ll:
             raise pp.ParseException(
                 instring, loc, f"Message too short for block length length {ll}", self
             )
-        l = int(instring[loc : loc + ll])
+        if not (digits.isascii() and digits.isdigit()):
+            raise pp.ParseException(
+                instring, loc, f"Invalid block length {digits}", self
+            )
+        l = int(digits)
         loc += ll
-        if loc + l >= len(instring):
+        # The block may end the message
+        if loc + l > len(instring):
             raise pp.ParseException(
                 instring, loc, f"Message too short for block length {l}", self
             )
@@ -157,8 +183,86 @@ program_message = pp.Optional(
 )
 
 
+# A fast path for the common messages: headers, decimal numbers with simple
+# suffixes and character data. Anything else (strings, blocks, non-decimal numbers,
+# expressions, odd spacing or errors) is left to the grammar above.
+
+Message = collections.namedtuple("Message", ("commands",))
+Command = collections.namedtuple("Command", ("header", "args"))
+Number = collections.namedtuple("Number", ("value", "suffix"))
+
+
+class ProgramData:
+    """A program data element, readable like the ones made by `program_data`.
+
+    As with `pp.ParseResults`, the result name that is not there reads as "".
+    """
+
+    __slots__ = ("symbol", "number")
+
+    def __init__(self, symbol="", number=""):
+        self.symbol = symbol
+        self.number = number
+
+    def getName(self):
+        return "symbol" if self.symbol else "number"
+
+
+# Same as the default whitespace of the grammar
+_whitespace_chars = "".join(chr(c) for c in range(0x21) if c != 0x0A)
+_whitespace = "\\x00-\\x09\\x0b-\\x20"
+_mnemonic = "[A-Za-z][A-Za-z0-9_]*"
+_message_unit = re.compile(
+    rf"[{_whitespace}]*"
+    rf"(\*{_mnemonic}\??|:?{_mnemonic}(?::{_mnemonic})*\??)"
+    rf"(?:[{_whitespace}]+([^{_whitespace}].*?))?"
+    rf"[{_whitespace}]*",
+    re.DOTALL,
+)
+_symbol = re.compile(_mnemonic)
+_number = re.compile(
+    r"([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))"
+    r"(?:[eE]([+-]?[0-9]+))?"
+    r"((?:[A-Za-z]+(?:/[A-Za-z]+)?)?)"
+)
+
+
+def tokenize(string):
+    """Parse a simple program message without the grammar.
+
+    Returns None for the messages this does not handle, which then need `parse`.
+    """
+    if "'" in string or "#" in string or "(" in string:
+        return None
+    commands = []
+    for unit in string.split(";"):
+        m = _message_unit.fullmatch(unit)
+        if m is None:
+            return None
+        header, data = m.groups()
+        args = []
+        if data is not None:
+            for datum in data.split(","):
+                datum = datum.strip(_whitespace_chars)
+                if _symbol.fullmatch(datum):
+                    args.append(ProgramData(symbol=datum))
+                    continue
+                n = _number.fullmatch(datum)
+                if n is None:
+                    return None
+                mantissa, exponent, suffix = n.groups()
+                if exponent is not None:
+                    exponent = int(exponent)
+                value = decimal_value(mantissa, exponent)
+                args.append(ProgramData(number=Number(value, suffix)))
+        commands.append(Command(header, args))
+    return Message(commands)
+
+
 def parse(string):
-    results = program_message.parseString(string, parseAll=True)
+    results = tokenize(string)
+    if results is None:
+        results = program_message.parseString(string, parseAll=True)
     #    results.pprint()
     return results
 
@@ -201,6 +305,11 @@ variative_header << (
 )
 
 
+# The short form of a mnemonic drops its 4th letter when that is a vowel
+_VOWELS = frozenset("AEIOUY")
+_explicit_short_form = re.compile("[A-Z_0-9]+")
+
+
 def format_mnemonic_pr(parsed, ignore_case):
     variants = [""]
     for necessary, contents in list(parsed):
@@ -214,12 +323,12 @@ def format_mnemonic_pr(parsed, ignore_case):
         long_v = v.upper()
         more_variants.add(long_v)
         if ignore_case:
-            if len(long_v) > 3 and long_v[3] in "AEIOUY":
+            if len(long_v) > 3 and long_v[3] in _VOWELS:
                 more_variants.add(long_v[:3])
             elif len(long_v) > 4:
                 more_variants.add(long_v[:4])
         elif long_v != v:
-            m = re.match("[A-Z_0-9]+", v)
+            m = _explicit_short_form.match(v)
             if m:
                 more_variants.add(m.group(0))
             else:
@@ -229,15 +338,19 @@ def format_mnemonic_pr(parsed, ignore_case):
 
 
 def format_header_pr(parsed, ignore_case):
+    # Immutable, as the results of `parse_variative_header` are shared
     formated = []
     for necessary, contents in parsed.asList():
         if necessary:
-            formated.append((True, format_mnemonic_pr(contents, ignore_case)))
+            formated.append(
+                (True, frozenset(format_mnemonic_pr(contents, ignore_case)))
+            )
         else:
             formated.append((False, format_header_pr(contents, ignore_case)))
-    return formated
+    return tuple(formated)
 
 
+@functools.lru_cache(maxsize=4096)
 def parse_variative_header(header, ignore_case=True):
     if header.endswith("?"):
         query = True
@@ -8,26 +8,70 @@
 # will get the requests sent to their port via their input queue and must respond
 # using the output queue.
 #
-# Each experiment is in a separate thread, and each port listener also has its own
-# thread. Inter-thread communication is done entirely via i/o queues on the
-# individual instruments.
+# Each experiment is in a separate thread. All the sockets, listening or connected,
+# are served by a single thread running `Server.run`. Inter-thread communication
+# is done entirely via i/o queues on the individual instruments, and experiments
+# wake the server thread up when they have put replies into those queues.
 #
 
+import functools
+import logging
+import os
+import selectors
 import socket
 import threading
 import queue
-import time
+
+from instrument import drain_queue
+
+log = logging.getLogger(__name__)
+
+# Most systems refuse to send more buffers than that in one call
+IOV_MAX = 1024
+
+# Clients are paused while their instrument has that many lines to answer
+MAX_PENDING_LINES = 256
+
+
+def send_buffers(datasocket, buffers):
+    """Send as much of `buffers` as possible in a single system call,
+    returns the number of bytes sent"""
+    if hasattr(datasocket, "sendmsg"):
+        return datasocket.sendmsg(buffers[:IOV_MAX])
+    # No scatter-gather on this platform
+    return datasocket.send(b"".join(buffers))
+
+
+class ShutdownEvent(threading.Event):
+    """A `threading.Event` that also calls back the threads waiting on something else
+    when it is set, so that they do not have to poll it"""
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+
+    def call_on_set(self, callback):
+        self._callbacks.append(callback)
+
+    def set(self):
+        super().set()
+        for callback in self._callbacks:
+            callback()
 
 
 class Experiment(threading.Thread):
     """The `Experiment` is a thread containing all instruments
     for a single user. All interaction between instruments should happen here.
-    
+
     For running your own virtual experiments subclass this and add hooks that
     would connect the output of one instrument with inputs from the others.
-    
+
     Any subclass should defive a class variable `ports` containing a list of all
     available ports (instruments).
+
+    The instruments answer whatever is put into their input queues, be it from
+    the server or from a hook writing to another instrument. For that the
+    instruments must all be in `instruments` by the time the thread starts.
     """
 
     instruments = {}
@@ -36,18 +80,67 @@ class Experiment(threading.Thread):
         super().__init__(daemon=False)
         self.instruments = {}
         self.end_event = end_event
+        # Called when there are replies in the output queues, set by the `Server`
+        self.notify = None
+        # Instruments that got new messages in their input queues
+        self.pending = queue.Queue()
+        if isinstance(end_event, ShutdownEvent):
+            end_event.call_on_set(self.wake)
+            self._poll_interval = None
+        else:
+            # Nothing will wake us up, the end of the experiment must be polled
+            self._poll_interval = 0.5
+
+    def wake(self):
+        """Make `run` check whether the experiment has ended"""
+        self.pending.put(None)
+
+    def submit(self, instrument):
+        """Have `instrument` answer the messages put into its input queue"""
+        self.pending.put(instrument)
 
     def run(self):
-        """This makes every instrument poll for incoming messages"""
+        """This makes the instruments answer their incoming messages as they are submitted"""
+        for instrument in self.instruments.values():
+            instrument.iqueue.on_input = functools.partial(self.submit, instrument)
+            # In case something came before we listened
+            if not instrument.iqueue.empty():
+                self.submit(instrument)
+
         while not self.end_event.is_set():
             try:
-                for instrument in self.instruments.values():
-                    instrument.process_messages()
+                try:
+                    instrument = self.pending.get(timeout=self._poll_interval)
+                except queue.Empty:
+                    continue
+                if instrument is None:
+                    continue
+                if instrument.process_messages() and self.notify is not None:
+                    self.notify()
             except BaseException:
                 self.end_event.set()
                 raise
 
 
+class Connection:
+    """A connected client socket and the instrument it talks to"""
+
+    __slots__ = ("socket", "instrument", "buffer", "paused", "outgoing")
+
+    def __init__(self, datasocket, instrument):
+        self.socket = datasocket
+        self.instrument = instrument
+        # In case that the command is very long
+        # or extremely many commands come at once
+        # the buffer can store the incomplete tail
+        # until the rest comes along.
+        self.buffer = bytearray()
+        # Set while the instrument has no room for the complete lines in the buffer
+        self.paused = False
+        # Replies that the socket did not take yet
+        self.outgoing = []
+
+
 class Server:
     def __init__(
         self, experiment_class, local=False, max_clients=100, **experiment_kwargs
@@ -62,28 +155,97 @@ class Server:
 
         for port in self.exp_class.ports:
             self.sockets[port] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sockets[port].settimeout(1)
+            if os.name == "posix":
+                # The server closes its connections first, so a restarted server
+                # must be able to bind while they are still in TIME_WAIT
+                self.sockets[port].setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sockets[port].bind((hostname, port))
-            print(f"Socket bound at {hostname}:{port}")
+            log.info("Socket bound at %s:%d", hostname, port)
 
         self.experiments = {}
+        # The connected clients, only `run` modifies this
+        self.connections = []
         self.instrulock = threading.Lock()
-        self.buffer = b""
-        self.shutdown_event = threading.Event()
+        self.shutdown_event = ShutdownEvent()
+        # Only `run` reads from the sockets, so all connections can share it
+        self._recv_buffer = memoryview(bytearray(65536))
+
+        # Experiments write a byte here to wake `run` up
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self.shutdown_event.call_on_set(self.wakeup)
+
+    def wakeup(self):
+        """Make `run` send the replies waiting in the output queues
+        (or notice the shutdown)"""
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            # Plenty of wakeups pending already
+            pass
+        except OSError:
+            # Closed by `close`, there is no `run` to wake up anymore
+            pass
+
+    def close(self):
+        """Release the sockets, once `run` has returned"""
+        for serversocket in self.sockets.values():
+            serversocket.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
 
     def run(self):
         self.shutdown_event.clear()
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_receiver, selectors.EVENT_READ)
         for port, serversocket in self.sockets.items():
             serversocket.listen(self.max_clients)
-            threading.Thread(
-                target=self.listen, args=(serversocket,), daemon=False
-            ).start()
-        while not self.shutdown_event.is_set():
-            try:
-                time.sleep(0.05)
-            except BaseException as e:
-                self.shutdown_event.set()
-                raise
+            serversocket.setblocking(False)
+            selector.register(serversocket, selectors.EVENT_READ)
+            log.info("Listening at %s", serversocket.getsockname())
+
+        self.connections = connections = []
+        try:
+            while not self.shutdown_event.is_set():
+                for key, events in selector.select():
+                    if isinstance(key.data, Connection):
+                        connection = key.data
+                        if events & selectors.EVENT_READ and not self.communicate(
+                            connection
+                        ):
+                            selector.unregister(connection.socket)
+                            connection.socket.close()
+                            connections.remove(connection)
+                    elif key.fileobj is self._wakeup_receiver:
+                        try:
+                            while self._wakeup_receiver.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        connection = self.accept(key.fileobj)
+                        if connection is not None:
+                            selector.register(
+                                connection.socket, selectors.EVENT_READ, connection
+                            )
+                            connections.append(connection)
+
+                for connection in connections:
+                    if (
+                        connection.paused
+                        and connection.instrument.iqueue.qsize() < MAX_PENDING_LINES
+                    ):
+                        self.pass_lines(connection)
+                    self.send_replies(connection)
+                    self.update_events(selector, connection)
+        except BaseException:
+            self.shutdown_event.set()
+            raise
+        finally:
+            for connection in connections:
+                connection.socket.close()
+            selector.close()
 
     def instrument(self, port, address):
         with self.instrulock:
@@ -91,6 +253,7 @@ class Server:
                 self.experiments[address] = self.exp_class(
                     self.shutdown_event, **self.exp_kwargs
                 )
+                self.experiments[address].notify = self.wakeup
                 self.experiments[address].start()
             try:
                 return self.experiments[address].instruments[port]
@@ -100,32 +263,26 @@ class Server:
                     f"Available ports are {tuple(self.experiments[address].instruments.keys())}"
                 )
 
-    def listen(self, serversocket):
-        print(f"Listening at {serversocket.getsockname()}")
-        while not self.shutdown_event.is_set():
-            # accept connections from outside
-            try:
-                (clientsocket, address) = serversocket.accept()
-                clientsocket.settimeout(1)
-                print(f"Connection from {address}")
-                instrument = self.instrument(serversocket.getsockname()[1], address[0])
-                threading.Thread(
-                    target=self.communicate,
-                    args=(clientsocket, instrument),
-                    daemon=False,
-                ).start()
-            except socket.timeout:
-                pass
-            except BaseException:
-                self.shutdown_event.set()
-                raise
+    def accept(self, serversocket):
+        """Accept a connection from outside, returns None if there was none after all"""
+        try:
+            clientsocket, address = serversocket.accept()
+        except BlockingIOError:
+            return None
+        clientsocket.setblocking(False)
+        # Replies are already coalesced by `send_replies`, waiting for more
+        # only delays them
+        clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info("Connection from %s", address)
+        instrument = self.instrument(serversocket.getsockname()[1], address[0])
+        return Connection(clientsocket, instrument)
 
     # Locks
     #
-    # The socket-listening thread needs write access to its instrument.
+    # The socket-serving thread needs write access to the instruments.
     # A change of a parameter may trigger an experiment hook, which will write
     # to the same instrument (no problem) or to a different instrument (problem,
-    # if another socket-listening thread tries to change that different instrument
+    # if the socket thread tries to change that different instrument
     # at the same time).
     #
     # The most obvious solution would be to put a lock on every instrument,
@@ -143,40 +300,97 @@ class Server:
     # response from the output queue. The experiment will make the instruments
     # poll the queues with a certain periodicity.
     #
-    def communicate(self, datasocket, instrument):
-        line_end_chars = instrument.lineending
-        datasocket.settimeout(0.05)
-        while not self.shutdown_event.is_set():
-            # In case that the command is very long
-            # or extremely many commands come at once
-            # the buffer can store the incomplete tail
-            # until the rest comes along.
-            try:
-                things = self.buffer + datasocket.recv(4096)
-                commands = things.split(line_end_chars)
-                self.buffer = commands[-1]
-                for cmd in commands[:-1]:
-                    try:
-                        instrument.iqueue.put(cmd)
-                    except queue.Full:
-                        # OK, this is bad, the instrument is not processing for some reason.
-                        print(f"Queue full on {instrument.name}:{datasocket.port}")
-                        instrument.iqueue.join()  # That might block indefinitely
-                        instrument.iqueue.put(cmd)
-
-            except socket.timeout:
-                pass
-            except BaseException:
-                self.shutdown_event.set()
-                raise
+    def communicate(self, connection):
+        """Pass the complete lines that came from `connection` to its instrument.
 
-            while not instrument.oqueue.empty():
-                try:
-                    datasocket.send(instrument.oqueue.get(timeout=0.05))
-                except queue.Empty:
-                    # This thread is the only consumer, so this outcome
-                    # is almost impossible, but even if the queue is empty,
-                    # the cycle is not going to run again
-                    pass
-            # It is possible that we miss the instrument response
-            # But we should get it again on the next run.
+        Returns False once the client has closed the connection.
+        """
+        try:
+            size = connection.socket.recv_into(self._recv_buffer)
+        except BlockingIOError:
+            return True
+        except ConnectionError:
+            return False
+        if not size:
+            return False
+
+        buffer = connection.buffer
+        # The kept tail holds no complete terminator, no need to search it again
+        offset = max(0, len(buffer) - len(connection.instrument.lineending) + 1)
+        buffer += self._recv_buffer[:size]
+        self.pass_lines(connection, offset)
+        return True
+
+    def pass_lines(self, connection, offset=0):
+        """Put the complete lines in the buffer of `connection` into the input queue
+        of its instrument, the first terminator being at `offset` or later.
+
+        Once `MAX_PENDING_LINES` are waiting in the queue, the remaining lines
+        stay in the buffer and the connection is paused until the instrument
+        catches up. The queue itself is unbounded, as hooks write there too.
+        """
+        instrument = connection.instrument
+        iqueue = instrument.iqueue
+        buffer = connection.buffer
+        ending = instrument.lineending
+        start = 0
+        end = buffer.find(ending, offset)
+        with memoryview(buffer) as view:
+            while end >= 0:
+                if iqueue.qsize() >= MAX_PENDING_LINES:
+                    # Only once per pause, not on every retry while paused
+                    if not connection.paused:
+                        log.warning(
+                            "Queue full on %s:%s, pausing the client",
+                            instrument.name,
+                            connection.socket.getsockname(),
+                        )
+                    break
+                iqueue.put(bytes(view[start:end]))
+                start = end + len(ending)
+                end = buffer.find(ending, start)
+        connection.paused = end >= 0
+        if start:
+            # Trim the passed lines in place, keeping the rest;
+            # the experiment gets to answer them via `InputQueue.on_input`
+            del buffer[:start]
+
+    def send_replies(self, connection):
+        """Send whatever the instrument has answered so far without blocking"""
+        outgoing = connection.outgoing
+        outgoing.extend(drain_queue(connection.instrument.oqueue))
+        if not outgoing:
+            return
+
+        try:
+            sent = send_buffers(connection.socket, outgoing)
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            # The next read will find the connection closed
+            outgoing.clear()
+            connection.paused = False
+            return
+        while sent:
+            if sent < len(outgoing[0]):
+                # A view, not a copy of the whole unsent tail every time
+                outgoing[0] = memoryview(outgoing[0])[sent:]
+                break
+            sent -= len(outgoing.pop(0))
+
+    def update_events(self, selector, connection):
+        """Have `selector` watch `connection` for reading unless it is paused,
+        and for writing while some of the replies are left"""
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if connection.outgoing:
+            events |= selectors.EVENT_WRITE
+        key = selector.get_map().get(connection.socket)
+        registered = 0 if key is None else key.events
+        if events == registered:
+            return
+        if not events:
+            selector.unregister(connection.socket)
+        elif not registered:
+            selector.register(connection.socket, events, connection)
+        else:
+            selector.modify(connection.socket, events, connection)
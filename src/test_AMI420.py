@@ -1,5 +1,6 @@
 import AMI420
 
+import gc
 import unittest
 import time
 
@@ -17,6 +18,52 @@ class TestAMI420(unittest.TestCase):
     def test_init(self):
         self.assertRun("*IDN?", "AMERICAN MAGNETICS INC.,MODEL 420,virtual")
 
+    def test_constants(self):
+        self.assertRun("*TST?;:SUPP:VOLT:MIN?;:SUPP:CURR:MAX?", "1", "-10", "100")
+        self.assertRun(":AB?;:PS?;:PS:TIME?", "0", "0", "0")
+
+    def test_log(self):
+        self.magnet.ramp_thread.debug = True
+        self.assertRun(":PAUSE", None)
+        while tuple(self.magnet.process(":STATE?")) == ("9",):
+            time.sleep(0.01)
+        self.assertEqual(self.magnet.ramp_thread.drain(), ["PAUSE button"])
+        self.assertEqual(self.magnet.ramp_thread.drain(), [])
+
+    def test_collected(self):
+        thread = self.magnet.ramp_thread
+        self.magnet = AMI420.AMI420(1.5, 7)
+        gc.collect()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_reset_ramp(self):
+        self.assertRun(":CONF:RAMP:FIELD 1T,60T/min;:RAMP", None, None)
+        time.sleep(0.3)
+        self.assertRun("*RST;:FIELD:MAG?", None, "0.0000")
+        while tuple(self.magnet.process(":STATE?")) != ("9",):
+            time.sleep(0.01)
+        # Past the end of the interrupted ramp
+        time.sleep(1)
+        self.assertRun(":STATE?;:FIELD:MAG?", "9", "0.0000")
+
+    def test_limits(self):
+        self.assertRun(":CONF:VOLT:LIM MAX;:VOLT:LIM?", None, "10.0000")
+        self.assertRun(":CONF:VOLT:LIM MIN;:VOLT:LIM?", None, "0.0000")
+        self.assertRun(":CONF:VOLT:LIM DEF;:VOLT:LIM?", None, "10.0000")
+
+    def test_overflow(self):
+        big = "1" + "0" * 400
+        for line in (
+            ":CONF:FIELD:PROG 1E400",
+            ":CONF:FIELD:PROG 1.0E400",
+            ":CONF:RAMP:RATE:FIELD 1E400",
+            ":CONF:FIELD:PROG " + big,
+        ):
+            self.magnet.iqueue.put(line.encode())
+            self.magnet.process_messages()
+            self.assertRun("*ERR?", f'ERROR: {line} -105,"Out of range"')
+
     def test_units(self):
         self.assertRun(":RAMP:RATE:UNITS?", "0")  # sec^-1
         self.assertRun(":FIELD:UNITS?", "0")  # kG
@@ -148,6 +195,17 @@ class TestAMI420(unittest.TestCase):
             "2.2500,900.0000",
         )
 
+    def test_current_units(self):
+        # Currents do not depend on the field units
+        self.assertRun(":FIELD:UNITS?", "0")  # kG
+        self.assertRun(
+            ":CONF:RAMP:CURR 1A,2A/s;:CURR:PROG?;:RAMP:RATE:CURR?;:RAMP:CURR?",
+            None,
+            "1.0000",
+            "2.0000",
+            "1.0000,2.0000",
+        )
+
     def test_ramp(self):
         self.assertRun(":CONF:RAMP:FIELD 1T,10T/min", None)
         self.assertRun(":STATE?", "9")
@@ -7,7 +7,7 @@ from instrument import (
     hookable,
 )
 
-# from server import Server, Experiment
+from server import Experiment, ShutdownEvent, MAX_PENDING_LINES
 
 
 class Voltmeter(VirtualInstrument):
@@ -75,6 +75,17 @@ class OhmExperiment(Experiment):
             self.instruments[self.PORT_V].voltage = 0
 
 
+class QueryingExperiment(OhmExperiment):
+    """Asks the voltmeter for the voltage whenever the current changes"""
+
+    def __init__(self, client_ip, resistance):
+        super().__init__(client_ip, resistance)
+        self.instruments[self.PORT_I].add_hook(self.query, "current")
+
+    def query(self):
+        self.instruments[self.PORT_V].iqueue.put(b":VOLT?")
+
+
 class TestHooks(unittest.TestCase):
     def setUp(self):
         self.experiment = OhmExperiment(None, 1e3)
@@ -93,3 +104,38 @@ class TestHooks(unittest.TestCase):
     def test_synched(self):
         self.assertRun(OhmExperiment.PORT_I, ":STAT ON;:CURR 3A", None, None)
         self.assertRun(OhmExperiment.PORT_V, ":VOLT?", "3000.00")
+
+    def test_hook_backed_up(self):
+        # A client may keep the voltmeter as busy as the server allows,
+        # the hook must still be able to write to it
+        self.experiment = QueryingExperiment(None, 1e3)
+        source = self.experiment.instruments[OhmExperiment.PORT_I]
+        voltmeter = self.experiment.instruments[OhmExperiment.PORT_V]
+        for i in range(MAX_PENDING_LINES):
+            voltmeter.iqueue.put(b":VOLT?")
+        source.iqueue.put(b":STAT ON;:CURR 3A")
+        source.process_messages()
+        self.assertEqual(voltmeter.iqueue.qsize(), MAX_PENDING_LINES + 1)
+
+
+class TestRunning(unittest.TestCase):
+    def setUp(self):
+        self.end_event = ShutdownEvent()
+        self.experiment = QueryingExperiment(self.end_event, 1e3)
+        self.experiment.start()
+
+    def tearDown(self):
+        self.end_event.set()
+        self.experiment.join()
+
+    def test_input(self):
+        # Nobody calls `submit`, the input queue does
+        source = self.experiment.instruments[OhmExperiment.PORT_I]
+        source.iqueue.put(b":STAT ON")
+        self.assertEqual(source.oqueue.get(timeout=1), b"\n")
+
+    def test_hook_input(self):
+        source = self.experiment.instruments[OhmExperiment.PORT_I]
+        voltmeter = self.experiment.instruments[OhmExperiment.PORT_V]
+        source.iqueue.put(b":STAT ON;:CURR 3A")
+        self.assertEqual(voltmeter.oqueue.get(timeout=1), b"3000.00\n")
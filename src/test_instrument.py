@@ -0,0 +1,70 @@
+import instrument
+import scpi
+
+import unittest
+
+
+class Dummy(instrument.VirtualInstrument):
+    def __init__(self):
+        super().__init__("Dummy")
+
+
+class TestMessages(unittest.TestCase):
+    def setUp(self):
+        self.instrument = Dummy()
+
+    def assertAnswers(self, lines, reply):
+        for line in lines:
+            self.instrument.iqueue.put(line)
+        self.instrument.process_messages()
+        self.assertEqual(self.instrument.oqueue.get_nowait(), reply)
+
+    def test_messages(self):
+        self.instrument.iqueue.put(b"*idn?")
+        self.instrument.iqueue.put(b"*IDN?;*WAI;*IDN?")
+        self.instrument.process_messages()
+        self.assertEqual(self.instrument.oqueue.get_nowait(), b"Dummy\nDummy;Dummy\n")
+        self.assertTrue(self.instrument.oqueue.empty())
+        self.instrument.iqueue.join()
+
+    def test_lineending(self):
+        self.instrument.lineending = b"\r\n"
+        self.assertAnswers([b"*IDN?", b"*IDN?"], b"Dummy\r\nDummy\r\n")
+
+    def test_errors(self):
+        self.assertAnswers([b":BOGUS"], b"\n")
+        self.assertAnswers([b"*ERR?"], b"ERROR: :BOGUS Unsupported command :BOGUS\n")
+        self.assertAnswers([b"*ERR?"], b"No errors\n")
+
+    def test_long_line(self):
+        line = b";".join([b"*IDN?"] * 100)
+        self.assertGreater(len(line), instrument.MAX_CACHED_LINE)
+        answer = b";".join([b"Dummy"] * 100) + b"\n"
+        # Twice, in case only the first parse works
+        self.assertAnswers([line, line], answer * 2)
+
+    def test_long_line_errors(self):
+        line = b";".join([b"*IDN?"] * 100) + b";:BOGUS"
+        self.assertAnswers([line], b";".join([b"Dummy"] * 100) + b"\n")
+        self.assertAnswers(
+            [b"*ERR?"], b"ERROR: " + line + b" Unsupported command :BOGUS\n"
+        )
+        self.assertAnswers([b"*ERR?"], b"No errors\n")
+
+
+class TestFloatValue(unittest.TestCase):
+    def parse(self, value, **kwargs):
+        (datum,) = scpi.parse(f":A {value}").commands[0].args
+        return instrument.get_float_value(datum, (0, 20), **kwargs)
+
+    def test_default_units(self):
+        # A different callable on every call, like a bound method per instrument
+        for scale in (2, 5):
+            units = {"A": 1, None: lambda: scale}
+            self.assertEqual(self.parse("3", units=units), 3 * scale)
+            self.assertEqual(self.parse("3A", units=units), 3)
+            self.assertEqual(self.parse("3mA", units=units), 0.003)
+
+
+if __name__ == "__main__":
+    unittest.main()
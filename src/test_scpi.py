@@ -0,0 +1,92 @@
+import scpi
+
+import unittest
+
+
+def flatten(message):
+    """What process() reads from a parsed message, as plain tuples"""
+    commands = []
+    for command in message.commands:
+        args = []
+        for arg in command.args:
+            if arg.getName() == "number":
+                number = arg.number
+                args.append((number.value, type(number.value), number.suffix))
+            else:
+                args.append(arg.symbol)
+        commands.append((command.header, args))
+    return commands
+
+
+class TestTokenize(unittest.TestCase):
+    def assertSameAsGrammar(self, message):
+        tokens = scpi.tokenize(message)
+        self.assertIsNotNone(tokens, message)
+        self.assertEqual(
+            flatten(tokens),
+            flatten(scpi.program_message.parseString(message, parseAll=True)),
+            message,
+        )
+
+    def test_headers(self):
+        self.assertSameAsGrammar("*IDN?")
+        self.assertSameAsGrammar("*RST;*IDN?")
+        self.assertSameAsGrammar(" :RAMP:RATE:UNITS? ;FIELD:UNITS?")
+        self.assertSameAsGrammar(":CONF:FIELD:PROG ;A?")
+
+    def test_numbers(self):
+        self.assertSameAsGrammar(":A 1,-0,+7,007,1.,.5,1.50")
+        self.assertSameAsGrammar(":A 1e3,1E+2,1.5e-3,1e0")
+        self.assertSameAsGrammar(":A 1.5kG,2A/S,1G/MIN,1e")
+
+    def test_rounding(self):
+        self.assertSameAsGrammar(":A 3E-1,1.1E2")
+        values = [
+            arg.number.value for arg in scpi.parse(":A 3E-1,1.1E2").commands[0].args
+        ]
+        self.assertEqual(values, [0.3, 110.0])
+
+    def test_overflow(self):
+        self.assertSameAsGrammar(":A 1E400,1.0E400,1E999999999")
+        values = [
+            arg.number.value
+            for arg in scpi.parse(":A 1E400,1E999999999").commands[0].args
+        ]
+        self.assertEqual(values, [float("inf")] * 2)
+
+    def test_symbols(self):
+        self.assertSameAsGrammar(":A ON , OFF,MAX\t,B2_X")
+
+    def test_fallback(self):
+        for message in (
+            "",
+            "*IDN?;",
+            ":A 'quoted'",
+            ":A #H1F",
+            ":A #15hello",
+            ":A 1 A",
+            ":A 12AB3",
+            ":A 1,,2",
+            ":A?1",
+        ):
+            self.assertIsNone(scpi.tokenize(message), message)
+
+
+class TestFiniteBlock(unittest.TestCase):
+    def assertBlock(self, string, block):
+        self.assertEqual(scpi.FiniteBlock().parseString(string)[0], block)
+
+    def test_block(self):
+        self.assertBlock("#111", b"1")
+        self.assertBlock("#216stranger things;", b"stranger things;")
+        self.assertBlock("#215stranger things;", b"stranger things")
+
+    def test_in_message(self):
+        (arg,) = scpi.parse(":A #13abc").commands[0].args
+        self.assertEqual(arg.getName(), "block")
+        self.assertEqual(arg.block, b"abc")
+
+    def test_short(self):
+        for string in ("#", "#1", "#15ab", "#2x1a"):
+            with self.assertRaises(scpi.pp.ParseException):
+                scpi.FiniteBlock().parseString(string)
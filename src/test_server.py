@@ -2,15 +2,41 @@ import server
 import instrument
 import unittest
 import threading
-import pyvisa
+import socket
+import time
+
+try:
+    import pyvisa
+except ImportError:
+    pyvisa = None
 
 PORT = 9001
+# Larger than the socket buffers, so that it can only be sent in parts
+BIG_REPLY = 1 << 23
 
 
 class Dummy(instrument.VirtualInstrument):
+    commands = instrument.CommandTree(instrument.VirtualInstrument.commands)
+
+    @commands.add(":VALue")
+    def set_value(self, parsed_value):
+        self.value = instrument.get_float_value(parsed_value, (0, 1e6))
+
+    @commands.add(":VALue?")
+    def get_value(self):
+        return str(int(self.value))
+
+    @commands.add(":BIG?")
+    def get_big(self):
+        return "X" * BIG_REPLY
+
     def __init__(self):
         super().__init__("Dummy")
 
+    def reset(self):
+        self.value = 0
+        super().reset()
+
 
 class DummyExperiment(server.Experiment):
     ports = (9001,)
@@ -22,11 +48,24 @@ class DummyExperiment(server.Experiment):
         }
 
 
-class ServerTest(unittest.TestCase):
+class RunningServerTest(unittest.TestCase):
     def setUp(self):
         self.server = server.Server(DummyExperiment, local=True)
         self.thread = threading.Thread(target=self.server.run)
         self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown_event.set()
+        self.thread.join()
+        for experiment in self.server.experiments.values():
+            experiment.join()
+        self.server.close()
+
+
+@unittest.skipIf(pyvisa is None, "pyvisa is not installed")
+class ServerTest(RunningServerTest):
+    def setUp(self):
+        super().setUp()
         self.rm = pyvisa.ResourceManager()
 
     def test_connection(self):
@@ -42,6 +81,91 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(inst.query("*IDN?"), "Dummy")
         inst.close()
 
-    def tearDown(self):
+
+class SocketTest(RunningServerTest):
+    def connect(self):
+        # `run` might not be listening yet
+        deadline = time.monotonic() + 1
+        while True:
+            try:
+                client = socket.create_connection(("localhost", PORT), timeout=5)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.addCleanup(client.close)
+        return client
+
+    def receive(self, client, size):
+        """Read `size` bytes from `client`, or less if it gets closed"""
+        data = bytearray()
+        while len(data) < size:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def assertRuns(self, client, message, reply):
+        client.sendall(message)
+        self.assertEqual(self.receive(client, len(reply)), reply)
+
+    def test_query(self):
+        client = self.connect()
+        self.assertRuns(client, b"*IDN?\n", b"Dummy\n")
+
+    def test_split_command(self):
+        client = self.connect()
+        client.sendall(b":VAL 1")
+        # Make sure that the server receives the halves separately
+        time.sleep(0.05)
+        self.assertRuns(client, b"2;:VAL?\n", b"12\n")
+
+    def test_pipeline(self):
+        # Much more than fits into the input queue of the instrument
+        count = 8 * server.MAX_PENDING_LINES
+        client = self.connect()
+        self.assertRuns(
+            client,
+            b"".join(b":VAL %d;:VAL?\n" % i for i in range(count)),
+            b"".join(b"%d\n" % i for i in range(count)),
+        )
+
+    def test_big_reply(self):
+        client = self.connect()
+        client.sendall(b":BIG?\n")
+        # Let the socket buffers fill up before anything is read
+        time.sleep(0.1)
+        self.assertEqual(self.receive(client, BIG_REPLY + 1), b"X" * BIG_REPLY + b"\n")
+
+    def test_shutdown(self):
+        client = self.connect()
+        self.assertRuns(client, b"*IDN?\n", b"Dummy\n")
+        start = time.monotonic()
         self.server.shutdown_event.set()
-        self.thread.join()
+        self.thread.join(1)
+        self.assertFalse(self.thread.is_alive())
+        # Woken up by the shutdown, not by a timeout
+        self.assertLess(time.monotonic() - start, 0.25)
+        self.assertEqual(client.recv(100), b"")
+
+    def test_set_after_close(self):
+        self.tearDown()
+        # The event may still be set, e.g. by an experiment, once the server is closed
+        self.server.shutdown_event.set()
+        self.server.wakeup()
+
+    def test_disconnect(self):
+        client = self.connect()
+        self.assertRuns(client, b"*IDN?\n", b"Dummy\n")
+        self.assertEqual(len(self.server.connections), 1)
+        client.close()
+        deadline = time.monotonic() + 1
+        while self.server.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.connections, [])
+
+
+if __name__ == "__main__":
+    unittest.main()